@@ -8,23 +8,31 @@ AdBlock 规则集合器 - 美化版
 
 import os
 import re
+import sys
+import argparse
 import time
 import requests
 import threading
-import queue
 from datetime import datetime, timedelta, timezone
-from typing import List, Set, Dict, Tuple
+from typing import List, Dict, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
+import tempfile
 import gzip
 import json
 
 # 禁用SSL警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# 默认下载并发数
+DEFAULT_MAX_WORKERS = 16
+
 class AdBlockRuleCollector:
-    def __init__(self):
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
         self.sources_dir = os.path.join(self.base_dir, "rules", "sources")
         self.outputs_dir = os.path.join(self.base_dir, "rules", "outputs")
@@ -37,11 +45,31 @@ class AdBlockRuleCollector:
         os.makedirs(self.sources_dir, exist_ok=True)
         os.makedirs(self.outputs_dir, exist_ok=True)
         
+        # 下载并发数（I/O密集，线程数可以明显多于CPU核数）
+        self.max_workers = max_workers
+        
         # 用户代理
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
         }
         
+        # 共享会话，各线程复用到同一主机的 TCP/TLS 连接
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.verify = False
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers,
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                respect_retry_after_header=True,
+            ),
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
         # 规则统计
         self.stats = {
             'white_rules': 0,
@@ -52,11 +80,14 @@ class AdBlockRuleCollector:
             'duplicate_removed': 0,
         }
         
-        # 内存优化
-        self.white_rules_hashes = set()
-        self.black_rules_hashes = set()
+        # 跨源去重：直接以规则字符串为键，避免逐条计算MD5
+        self.white_rules_seen = set()
+        self.black_rules_seen = set()
         self.lock = threading.Lock()
         
+        # 提取 ||domain^ / @@||domain^ 规则中的域名部分，用于排序
+        self.domain_rule_pattern = re.compile(r'(?:@@)?\|\|([^\^$/|:*]+)')
+        
         # 临时文件存储
         self.temp_dir = os.path.join(self.base_dir, "temp")
         os.makedirs(self.temp_dir, exist_ok=True)
@@ -72,19 +103,22 @@ class AdBlockRuleCollector:
                     f.write(f"{name} {url}\n")
             return default_sources
         
+        # 单次遍历：跳过空行、注释和非 http(s) 地址
         sources = []
         with open(source_file, 'r', encoding='utf-8') as f:
             for line in f:
                 line = line.strip()
-                if line and not line.startswith('#'):
-                    parts = line.split(maxsplit=1)
-                    if len(parts) == 2:
-                        name, url = parts
-                        sources.append((name.strip(), url.strip()))
-                    else:
-                        url = line
-                        name = self._extract_name_from_url(url)
-                        sources.append((name, url))
+                if not line or line[0] == '#':
+                    continue
+                parts = line.split(maxsplit=1)
+                if len(parts) == 2:
+                    name, url = parts[0], parts[1].strip()
+                else:
+                    name, url = None, line
+                if not url.startswith(('http://', 'https://')):
+                    print(f"⚠️ 跳过无效规则源 ({source_file}): {line}")
+                    continue
+                sources.append((name or self._extract_name_from_url(url), url))
         return sources
     
     def _extract_name_from_url(self, url: str) -> str:
@@ -119,64 +153,86 @@ class AdBlockRuleCollector:
     
     def fetch_rules(self, source_name: str, url: str, source_type: str) -> Dict:
         """从URL获取规则"""
-        temp_file = os.path.join(self.temp_dir, f"{hashlib.md5(url.encode()).hexdigest()}.txt")
+        cache_key = hashlib.md5(url.encode()).hexdigest()
+        temp_file = os.path.join(self.temp_dir, f"{cache_key}.txt")
+        meta_file = os.path.join(self.temp_dir, f"{cache_key}.json")
         
         try:
-            # 缓存检查
+            candidates = None
+            request_headers = {}
+            
+            # 缓存检查：一小时内直接使用，过期则带上 ETag/Last-Modified 做条件请求
             if os.path.exists(temp_file):
                 file_age = time.time() - os.path.getmtime(temp_file)
                 if file_age < 3600:
-                    with open(temp_file, 'r', encoding='utf-8') as f:
-                        rules = [line.strip() for line in f if line.strip()]
-                    
-                    with self.lock:
-                        if source_type == 'white':
-                            self.stats['white_rules'] += len(rules)
-                        else:
-                            self.stats['black_rules'] += len(rules)
-                        self.stats['sources_processed'] += 1
-                    
-                    print(f"✓ 从缓存读取: {source_name} ({len(rules)} 条规则)")
-                    return {'name': source_name, 'url': url, 'count': len(rules), 'rules': rules}
+                    candidates = self._read_cache(temp_file)
+                    status = "从缓存读取"
+                else:
+                    # 元数据文件缺失、为空或损坏时视为没有，直接发普通请求
+                    try:
+                        with open(meta_file, 'r', encoding='utf-8') as f:
+                            meta = json.load(f)
+                    except (OSError, ValueError):
+                        meta = {}
+                    if not isinstance(meta, dict):
+                        meta = {}
+                    if meta.get('etag'):
+                        request_headers['If-None-Match'] = meta['etag']
+                    if meta.get('last_modified'):
+                        request_headers['If-Modified-Since'] = meta['last_modified']
             
-            # 网络获取
-            print(f"正在获取: {source_name}")
-            response = requests.get(url, headers=self.headers, timeout=60, verify=False)
-            response.raise_for_status()
+            if candidates is None:
+                # 网络获取：边下载边解析，不在内存中保留完整响应文本
+                # 连接超时单独设短：失效主机尽快失败，不会在每次重试中各耗满60秒
+                with self.session.get(url, timeout=(10, 60), stream=True, headers=request_headers) as response:
+                    if response.status_code == 304:
+                        candidates = self._read_cache(temp_file)
+                        os.utime(temp_file)
+                        os.utime(meta_file)
+                        status = "未变化，使用缓存"
+                    else:
+                        response.raise_for_status()
+                        if 'charset' not in response.headers.get('Content-Type', ''):
+                            response.encoding = 'utf-8'
+                        
+                        candidates = []
+                        for line in response.iter_lines(chunk_size=65536, decode_unicode=True):
+                            line = line.strip()
+                            if self._is_valid_rule(line):
+                                candidates.append(line)
+                        
+                        # 保存缓存：保存该源的完整规则（去重前），缓存不依赖其他源的下载顺序
+                        # 先删除旧元数据再替换缓存，写入中断时不会让旧 ETag 配上残缺的缓存
+                        try:
+                            os.remove(meta_file)
+                        except FileNotFoundError:
+                            pass
+                        self._write_atomic(temp_file, '\n'.join(candidates) + '\n' if candidates else '')
+                        # 同一URL可能被多个线程同时下载，元数据同样经唯一临时文件替换
+                        self._write_atomic(meta_file, json.dumps({
+                            'etag': response.headers.get('ETag'),
+                            'last_modified': response.headers.get('Last-Modified'),
+                        }))
+                        status = "成功获取"
             
+            # 每个源只加一次锁完成去重
             rules = []
-            for line in response.text.splitlines():
-                line = line.strip()
-                if self._is_valid_rule(line):
-                    rule_hash = hashlib.md5(line.encode()).hexdigest()
-                    
-                    with self.lock:
-                        if source_type == 'white':
-                            if rule_hash in self.white_rules_hashes:
-                                self.stats['duplicate_removed'] += 1
-                                continue
-                            self.white_rules_hashes.add(rule_hash)
-                        else:
-                            if rule_hash in self.black_rules_hashes:
-                                self.stats['duplicate_removed'] += 1
-                                continue
-                            self.black_rules_hashes.add(rule_hash)
-                    
-                    rules.append(line)
-            
-            # 保存缓存
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                for rule in rules:
-                    f.write(rule + '\n')
-            
+            seen = self.white_rules_seen if source_type == 'white' else self.black_rules_seen
             with self.lock:
+                for line in candidates:
+                    if line in seen:
+                        continue
+                    seen.add(line)
+                    rules.append(line)
+                self.stats['duplicate_removed'] += len(candidates) - len(rules)
                 if source_type == 'white':
                     self.stats['white_rules'] += len(rules)
                 else:
                     self.stats['black_rules'] += len(rules)
                 self.stats['sources_processed'] += 1
+            del candidates
             
-            print(f"✓ 成功获取: {source_name} ({len(rules)} 条规则)")
+            print(f"✓ {status}: {source_name} ({len(rules)} 条规则)")
             return {'name': source_name, 'url': url, 'count': len(rules), 'rules': rules}
             
         except Exception as e:
@@ -185,108 +241,140 @@ class AdBlockRuleCollector:
             print(f"✗ 获取失败: {source_name} - {str(e)}")
             return {'name': source_name, 'url': url, 'count': 0, 'rules': [], 'error': str(e)}
     
+    def _write_atomic(self, path: str, content: str):
+        """先写入唯一的临时文件再替换，中断或并发写入时不会留下半个文件"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.temp_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def _read_cache(self, temp_file: str) -> List[str]:
+        """读取缓存的规则：缓存由本程序写入，每行已是去除空白的规则"""
+        with open(temp_file, 'r', encoding='utf-8') as f:
+            return [line for line in f.read().splitlines() if line]
+    
     def _is_valid_rule(self, rule: str) -> bool:
         """检查是否为有效的广告过滤规则"""
         if not rule or len(rule) > 1000:
             return False
         
-        if rule.startswith('!') or rule.startswith('[') or rule.startswith('#'):
+        # 注释、头部和hosts注释
+        if rule[0] in '![#':
             return False
         
-        if '##' in rule:
-            return True
-        
-        if rule.startswith('||') or rule.startswith('@@'):
+        # 绝大多数规则以 || 或 @@ 开头，先用前缀判断，免去整行扫描
+        if rule.startswith(('||', '@@')):
             return True
         
-        if '^' in rule or '$' in rule:
-            return True
-        
-        return False
+        return '##' in rule or '^' in rule or '$' in rule
+    
+    def _rule_sort_key(self, rule: str) -> str:
+        """规则排序键：域名规则按标签倒序（如 com.example.ads），其他规则排在最后"""
+        match = self.domain_rule_pattern.match(rule)
+        if match is None:
+            return '\U0010ffff' + rule
+        # 标签间用低于 '-' 的分隔符，避免 example-cdn.com 插入 example.com 与其子域之间
+        return '\x01'.join(match.group(1).split('.')[::-1]) + '\x00' + rule
     
-    def process_and_write_rules(self, all_rules_data: List[Dict]):
+    def process_and_write_rules(self, all_rules_data: List[Dict], now: datetime):
         """处理和写入规则文件"""
         print("\n⚙️ 处理和合并规则...")
         
-        white_rules = []
-        black_rules = []
+        # 以dict作为有序集合，边分类边去重
+        white_rules = {}
+        black_rules = {}
         
+        # 逐个源取出规则列表，分类后即释放，只保留名称、URL、数量等元信息
         for source_data in all_rules_data:
-            if 'rules' in source_data:
-                for rule in source_data['rules']:
+            rules = source_data.pop('rules', None)
+            if rules:
+                for rule in rules:
                     if rule.startswith('@@'):
-                        white_rules.append(rule)
+                        white_rules[rule] = None
                     else:
-                        black_rules.append(rule)
-        
-        white_rules = list(dict.fromkeys(white_rules))
-        black_rules = list(dict.fromkeys(black_rules))
+                        black_rules[rule] = None
         
-        final_rules = []
-        final_rules.extend(white_rules)
-        final_rules.extend(black_rules)
+        # 按域名标签倒序排序，同一父域名的规则相邻，压缩率更高，输出也不再依赖下载完成顺序
+        white_rules = sorted(white_rules, key=self._rule_sort_key)
+        black_rules = sorted(black_rules, key=self._rule_sort_key)
         
-        self.stats['total_rules'] = len(final_rules)
+        # 混合规则即白名单在前、黑名单在后，无需再拼接一份完整列表
+        total_rules = len(white_rules) + len(black_rules)
+        self.stats['total_rules'] = total_rules
         
         print(f"白名单规则: {len(white_rules)} 条")
         print(f"黑名单规则: {len(black_rules)} 条")
-        print(f"总规则数: {len(final_rules)} 条")
+        print(f"总规则数: {total_rules} 条")
         
         # 生成规则文件头
-        shanghai_tz = timezone(timedelta(hours=8))
-        update_time = datetime.now(shanghai_tz).strftime('%Y-%m-%d %H:%M:%S')
+        update_time = now.strftime('%Y-%m-%d %H:%M:%S')
         
         file_header = f"""! Title: AdBlock 综合过滤规则
 ! Description: 精准超级智能广告过滤规则集合器
-! Version: {datetime.now().strftime('%Y%m%d')}
+! Version: {now.strftime('%Y%m%d')}
 ! TimeUpdated: {update_time} (上海时间)
 ! Homepage: https://github.com/wansheng8/adblock
 ! Expires: 1 days
-! Total rules: {len(final_rules)}
+! Total rules: {total_rules}
 !
 """
         
-        # 写入混合规则文件
+        # 单次遍历同时写入混合规则、压缩版本和单独的规则文件
         print(f"\n💾 写入规则文件...")
         
         batch_size = 50000
-        with open(self.output_file, 'w', encoding='utf-8') as f:
-            f.write(file_header)
+        white_only_file = os.path.join(self.outputs_dir, "white_only.txt")
+        black_only_file = os.path.join(self.outputs_dir, "black_only.txt")
+        gz_file = self.output_file + '.gz'
+        output_files = (self.output_file, gz_file, white_only_file, black_only_file)
+        
+        # 先写入 .tmp 临时文件，全部完成后再原子替换，订阅者不会读到写了一半的文件
+        # 以二进制模式写入：每块文本只编码一次，供多个文件共用
+        # gzip 压缩是写入阶段最耗CPU的部分（zlib会释放GIL），交给单独的线程与明文写入重叠进行
+        with open(self.output_file + '.tmp', 'wb') as f_all, \
+                open(gz_file + '.tmp', 'wb') as f_gz_raw, \
+                gzip.GzipFile(filename=self.output_file, mode='wb', fileobj=f_gz_raw) as f_gz, \
+                open(white_only_file + '.tmp', 'wb') as f_white, \
+                open(black_only_file + '.tmp', 'wb') as f_black, \
+                ThreadPoolExecutor(max_workers=1) as gz_writer:
+            header_bytes = file_header.encode('utf-8')
+            f_all.write(header_bytes)
+            gz_pending = gz_writer.submit(f_gz.write, header_bytes)
+            f_white.write("! 仅白名单规则\n".encode('utf-8'))
+            f_black.write("! 仅黑名单规则\n".encode('utf-8'))
             
-            for i in range(0, len(final_rules), batch_size):
-                batch = final_rules[i:i + batch_size]
-                for rule in batch:
-                    f.write(rule + '\n')
-        
-        # 写入压缩版本
-        try:
-            with open(self.output_file, 'rb') as f_in:
-                with gzip.open(self.output_file + '.gz', 'wb') as f_out:
-                    f_out.writelines(f_in)
-            print(f"✓ 已创建压缩版本")
-        except Exception as e:
-            print(f"✗ 创建压缩版本失败: {e}")
-        
-        # 写入单独的规则文件
-        with open(os.path.join(self.outputs_dir, "white_only.txt"), 'w', encoding='utf-8') as f:
-            f.write("! 仅白名单规则\n")
-            for rule in white_rules:
-                f.write(rule + '\n')
+            # 按批拼接、编码，每批只编码一次再写入各个文件，避免整份规则的超大临时字符串
+            for rules, f_single in ((white_rules, f_white), (black_rules, f_black)):
+                rules = iter(rules)
+                while True:
+                    batch = list(islice(rules, batch_size))
+                    if not batch:
+                        break
+                    chunk = ('\n'.join(batch) + '\n').encode('utf-8')
+                    f_all.write(chunk)
+                    f_single.write(chunk)
+                    # 最多一批在压缩中，内存占用仍然有界
+                    gz_pending.result()
+                    gz_pending = gz_writer.submit(f_gz.write, chunk)
+            
+            gz_pending.result()
         
-        with open(os.path.join(self.outputs_dir, "black_only.txt"), 'w', encoding='utf-8') as f:
-            f.write("! 仅黑名单规则\n")
-            for rule in black_rules:
-                f.write(rule + '\n')
+        for path in output_files:
+            os.replace(path + '.tmp', path)
+        print(f"✓ 已创建压缩版本")
         
         # 写入统计文件
         with open(self.stats_file, 'w', encoding='utf-8') as f:
             json.dump(self.stats, f, ensure_ascii=False, indent=2)
     
-    def generate_readme(self, all_rules_data: List[Dict]) -> str:
+    def generate_readme(self, all_rules_data: List[Dict], now: datetime) -> str:
         """生成美化的README.md文件 - 只有三个部分"""
-        # 获取上海时间
-        shanghai_tz = timezone(timedelta(hours=8))
-        update_time = datetime.now(shanghai_tz).strftime('%Y年%m月%d日 %H:%M:%S')
+        update_time = now.strftime('%Y年%m月%d日 %H:%M:%S')
         total_rules = self.stats['total_rules']
         
         # 第一部分：名称介绍
@@ -366,11 +454,10 @@ class AdBlockRuleCollector:
         
         return readme_content
     
-    def run(self):
-        """主运行函数"""
-        print("=" * 70)
-        print("🛡️  AdBlock 规则集合器 - 美化版")
-        print("=" * 70)
+    def run(self) -> bool:
+        """主运行函数，返回是否成功生成规则"""
+        separator = "=" * 70
+        print(f"{separator}\n🛡️  AdBlock 规则集合器 - 美化版\n{separator}")
         
         self._cleanup_temp_files()
         
@@ -386,7 +473,9 @@ class AdBlockRuleCollector:
         print("\n🌐 开始获取规则...")
         all_rules_data = []
         
-        with ThreadPoolExecutor(max_workers=5) as executor:
+        workers = max(1, min(self.max_workers, len(white_sources) + len(black_sources)))
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
             futures = []
             
             for name, url in white_sources:
@@ -395,25 +484,33 @@ class AdBlockRuleCollector:
             for name, url in black_sources:
                 futures.append(executor.submit(self.fetch_rules, name, url, 'black'))
             
-            completed = 0
-            total = len(futures)
-            
             for future in as_completed(futures):
                 try:
-                    result = future.result()
-                    all_rules_data.append(result)
-                    completed += 1
-                    print(f"进度: {completed}/{total}")
+                    all_rules_data.append(future.result())
                 except Exception as e:
                     print(f"任务执行错误: {e}")
-                    completed += 1
+        
+        self.session.close()
+        
+        # 跨源去重集合只在下载阶段使用，释放后合并阶段的内存峰值更低
+        self.white_rules_seen.clear()
+        self.black_rules_seen.clear()
+        print(f"获取完成: 成功 {self.stats['sources_processed']} 个, 失败 {self.stats['sources_failed']} 个 (共 {len(futures)} 个)")
+        
+        # 所有源都失败时不写出任何文件并返回失败：非零退出码让工作流中止，避免提交空规则
+        if self.stats['sources_processed'] == 0:
+            print("❌ 没有成功获取任何规则源，跳过生成规则文件并以失败退出")
+            return False
+        
+        # 统一的更新时间（上海时间），保证规则文件和README一致
+        now = datetime.now(timezone(timedelta(hours=8)))
         
         # 处理并写入规则
-        self.process_and_write_rules(all_rules_data)
+        self.process_and_write_rules(all_rules_data, now)
         
         # 生成README
         print("\n📄 生成README.md...")
-        readme_content = self.generate_readme(all_rules_data)
+        readme_content = self.generate_readme(all_rules_data, now)
         
         try:
             with open(os.path.join(self.base_dir, "README.md"), 'w', encoding='utf-8') as f:
@@ -422,13 +519,17 @@ class AdBlockRuleCollector:
         except Exception as e:
             print(f"❌ 生成README.md失败: {e}")
         
-        # 打印统计信息
-        print("\n" + "=" * 70)
-        print("🎉 执行完成！")
-        print("=" * 70)
-        print(f"📊 总规则数: {self.stats['total_rules']:,}")
-        print(f"📁 输出文件已生成")
-        print("=" * 70)
+        # 打印统计信息（整段一次输出）
+        print("\n".join([
+            "",
+            separator,
+            "🎉 执行完成！",
+            separator,
+            f"📊 总规则数: {self.stats['total_rules']:,}",
+            "📁 输出文件已生成",
+            separator,
+        ]))
+        return True
     
     def _cleanup_temp_files(self):
         """清理临时文件"""
@@ -442,16 +543,29 @@ class AdBlockRuleCollector:
         except:
             pass
 
+def _positive_int(value: str) -> int:
+    """argparse 参数类型：正整数"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的整数: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必须为正整数: {value}")
+    return number
+
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="AdBlock 规则集合器：收集、合并、去重多源广告过滤规则")
+    parser.add_argument('--workers', type=_positive_int, default=DEFAULT_MAX_WORKERS,
+                        help=f"下载并发数（默认 {DEFAULT_MAX_WORKERS}）")
+    args = parser.parse_args()
+    
     try:
-        collector = AdBlockRuleCollector()
-        collector.run()
-        return 0
+        collector = AdBlockRuleCollector(max_workers=args.workers)
+        return 0 if collector.run() else 1
     except Exception as e:
         print(f"❌ 程序执行出错: {e}")
         return 1
 
 if __name__ == "__main__":
-    exit_code = main()
-    exit(exit_code)
+    sys.exit(main())